@@ -1,48 +1,179 @@
 """Script the recursively creates audio playlist files from a given starting directory"""
+from __future__ import annotations
+import json
 import os
+import struct
 import sys
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any
 from urllib.parse import quote
 
-from PIL import Image
-
 PLAYLIST_TEMPLATE = """
 #EXTINF:{0},{1}
 {2}
 """.strip()
+CACHE_FILENAME = ".playlist_cache.json"
+AUDIO_EXTENSIONS = ('.flac', '.wma', '.m4a', '.ogg', '.mp3', '.m4p')
+# Start of frame markers, these contain the image dimensions
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
 
 
 def is_audio_file(filename: str) -> bool:
-    return os.path.splitext(filename)[1] in ['.flac', '.wma', '.m4a', '.ogg', '.mp3', '.m4p']
+    return filename.endswith(AUDIO_EXTENSIONS)
 
 
-def main():
-    for path, _, files in os.walk(sys.argv[1]):
-        playlist_items = sorted([file for file in files if is_audio_file(file)])
-        image_files = [file for file in files if file.endswith(".jpg")]
-        if len(playlist_items) < 2:
-            continue
+def jpeg_size(filename: str) -> tuple[int, int] | None:
+    """Read the width and height from the JPEG headers without decoding the image"""
+    with open(filename, 'rb') as image_file:
+        if image_file.read(2) != b"\xff\xd8":
+            return None
+        while True:
+            byte = image_file.read(1)
+            if not byte:
+                return None
+            if byte != b"\xff":
+                continue
+            marker = image_file.read(1)
+            # Skip fill bytes
+            while marker == b"\xff":
+                marker = image_file.read(1)
+            if not marker:
+                return None
+            marker_type = marker[0]
+            if marker_type in JPEG_STANDALONE_MARKERS or marker_type == 0x00:
+                continue
+            header = image_file.read(2)
+            if len(header) != 2:
+                return None
+            (length,) = struct.unpack(">H", header)
+            if marker_type in JPEG_SOF_MARKERS:
+                frame_header = image_file.read(5)
+                if len(frame_header) != 5:
+                    return None
+                _, height, width = struct.unpack(">BHH", frame_header)
+                return width, height
+            image_file.seek(length - 2, os.SEEK_CUR)
+
+
+def image_size(image: os.DirEntry[str], cached: list[int | None] | None) -> list[int | None]:
+    """Return the modification time, file size and pixel count of an image, reusing the cached entry if unchanged"""
+    stat = image.stat()
+    if cached is not None and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+        return cached
+    dimensions = jpeg_size(image.path)
+    pixels = dimensions[0] * dimensions[1] if dimensions is not None else None
+    return [stat.st_mtime_ns, stat.st_size, pixels]
+
+
+def load_cache(filename: str) -> dict[str, Any]:
+    try:
+        with open(filename) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+class PlaylistCreator:
+    """Recursively creates playlists, skipping directories that haven't changed since the previous run"""
+
+    def __init__(self, root: str, executor: Executor, previous_cache: dict[str, Any]) -> None:
+        self.root = root
+        self.executor = executor
+        self.previous_cache = previous_cache
+        self.cache: dict[str, Any] = {}
 
+    def scan(self, path: str, mtime_ns: int) -> None:
+        """Create the playlist for a directory, then recurse into its subdirectories"""
+        playlist_name = os.path.split(path)[-1] + ".m3u"
+        subdirs = []
+        playlist_items = []
+        images = []
+        has_playlist = False
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry)
+                    elif not entry.is_file():
+                        continue
+                    elif is_audio_file(entry.name):
+                        playlist_items.append(entry.name)
+                    elif entry.name.endswith(".jpg"):
+                        images.append(entry)
+                    elif entry.name == playlist_name:
+                        has_playlist = True
+        except OSError:
+            # Skip unreadable directories, as os.walk does
+            return
+
+        key = os.path.relpath(path, self.root)
+        cached = self.previous_cache.get(key)
+        # Files are only added, removed or renamed if the directory modification time changes
+        if cached is not None and cached["mtime_ns"] == mtime_ns and has_playlist:
+            self.cache[key] = cached
+        elif len(playlist_items) >= 2:
+            dir_cache = self.create_playlist(path, playlist_name, playlist_items, images, cached)
+            # Creating a new playlist updates the directory modification time
+            dir_cache["mtime_ns"] = mtime_ns if has_playlist else os.stat(path).st_mtime_ns
+            self.cache[key] = dir_cache
+
+        for subdir in subdirs:
+            try:
+                subdir_mtime_ns = subdir.stat(follow_symlinks=False).st_mtime_ns
+            except OSError:
+                continue
+            self.scan(subdir.path, subdir_mtime_ns)
+
+    def create_playlist(
+        self,
+        path: str,
+        playlist_name: str,
+        playlist_items: list[str],
+        images: list[os.DirEntry[str]],
+        cached: dict[str, Any] | None,
+    ) -> dict[str, Any]:
+        """Write the playlist for a directory, returning the cached image sizes"""
+        playlist_items.sort()
         album_image = None
-        if image_files:
+        cached_images = cached["images"] if cached is not None else {}
+        image_sizes = {}
+        if images:
             max_size = 0
             # Select the largest image
-            for image_name in image_files:
-                image = Image.open(os.path.join(path, image_name))
-                size = image.width * image.height
+            image_infos = self.executor.map(image_size, images, [cached_images.get(image.name) for image in images])
+            for image, image_info in zip(images, image_infos):
+                image_sizes[image.name] = image_info
+                size = image_info[2]
+                if size is None:
+                    continue
                 if size > max_size:
                     max_size = size
-                    album_image = image_name
+                    album_image = image.name
 
-        playlist_name = os.path.split(path)[-1] + ".m3u"
+        lines = ["#EXTM3U"]
+        if album_image is not None:
+            lines.append(f"#EXTIMG:{album_image}")
+        # TODO: Get correct duration
+        duration = 100
+        lines.extend(
+            PLAYLIST_TEMPLATE.format(duration, os.path.splitext(item)[0], quote(item)) for item in playlist_items
+        )
         with open(os.path.join(path, playlist_name), 'w') as playlist_file:
-            print("#EXTM3U", file=playlist_file)
-            if album_image is not None:
-                print(f"#EXTIMG:{album_image}", file=playlist_file)
-            for item in playlist_items:
-                # TODO: Get correct duration
-                duration = 100
-                name = os.path.splitext(item)[0]
-                print(PLAYLIST_TEMPLATE.format(duration, name, quote(item)), file=playlist_file)
+            playlist_file.write("\n".join(lines) + "\n")
+        return {"images": image_sizes}
+
+
+def main():
+    root = sys.argv[1]
+    cache_path = os.path.join(root, CACHE_FILENAME)
+    # Bound the number of workers to limit the number of open image files
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        creator = PlaylistCreator(root, executor, load_cache(cache_path))
+        creator.scan(root, os.stat(root).st_mtime_ns)
+    with open(cache_path, 'w') as cache_file:
+        json.dump(creator.cache, cache_file)
 
 
 if __name__ == "__main__":
@@ -2,16 +2,16 @@ from __future__ import annotations
 import asyncio
 import os.path
 import re
+import shutil
 import signal
-from asyncio import IncompleteReadError
 from asyncio.subprocess import PIPE
 from dataclasses import dataclass
-from datetime import time, timedelta as delta, timedelta
+from datetime import timedelta
 from typing import TYPE_CHECKING, Any
-from urllib.parse import unquote
+from urllib.parse import unquote, urlparse
 
-import m3u8
 import voluptuous as vol
+from aiohttp import ClientTimeout
 
 from homeassistant.components.media_player.const import RepeatMode
 from homeassistant.const import EVENT_HOMEASSISTANT_STOP
@@ -26,7 +26,6 @@ from homeassistant.components.media_player import (
     MediaType,
     async_process_play_media_url,
 )
-from homeassistant.helpers import aiohttp_client
 from homeassistant.helpers.reload import setup_reload_service
 from homeassistant.util.dt import utcnow
 
@@ -40,6 +39,7 @@ from .const import (
 )
 
 if TYPE_CHECKING:
+    from asyncio import StreamReader
     from asyncio.subprocess import Process
 
     from homeassistant.core import HomeAssistant
@@ -55,18 +55,27 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         vol.Optional(CONF_NAME): cv.string,
     }
 )
-METADATA_REGEXES = (
-    re.compile(r"^(TITLE)=(.+)$", re.MULTILINE | re.IGNORECASE),
-    re.compile(r"^(ARTIST)=(.+)$", re.MULTILINE | re.IGNORECASE),
-    re.compile(r"^(ALBUM)=(.+)$", re.MULTILINE | re.IGNORECASE),
-)
-TITLE_REGEXES = (
-    re.compile(r"^StreamTitle=(.+)$", re.MULTILINE),
-    re.compile(r"^icy-name=(.+)$", re.MULTILINE),
-)
-DURATION_REGEX = re.compile(r"^ {2}Duration: ([\d:.]+),", re.MULTILINE)
-PROGRESS_REGEX = re.compile(r"time=(\d{2}:\d{2}:\d{2}\.\d{2})")
-BUF_SIZE = 64 * 1024 * 1024
+METADATA_REGEX = re.compile(r"^(TITLE|ARTIST|ALBUM)=([^\r\n]+)\r?$", re.MULTILINE | re.IGNORECASE)
+TITLE_REGEX = re.compile(r"^(StreamTitle|icy-name)=([^\r\n]+)\r?$", re.MULTILINE)
+# Title tags in order of preference
+TITLE_TAGS = ("StreamTitle", "icy-name")
+DURATION_REGEX = re.compile(r"^ {2}Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?),", re.MULTILINE)
+PROGRESS_REGEX = re.compile(rb"time=(\d{2}):(\d{2}):(\d{2}\.\d{2})")
+BUF_SIZE = 64 * 1024
+# Use the full path so subprocesses can be started with posix_spawn rather than fork/exec
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+OUTPUT_FORMAT_ARGS = ("-f", "u16le", "-acodec", "pcm_s16le", "-ac", "2", "-ar", "48000")
+PLAYLIST_EXTENSIONS = (".m3u", ".m3u8")
+CUSTOM_TAG_PREFIXES = ("#EXTIMG:", "#EXTVLCOPT:")
+PLAYLIST_TIMEOUT = ClientTimeout(total=5, sock_connect=2)
+# Seconds before the metadata of a network stream is probed again
+METADATA_TTL = 30
+METADATA_TIMEOUT = 2
+PLAYLIST_CACHE_TTL = 60
+PLAYLIST_CACHE_SIZE = 16
+PROCESS_STOP_TIMEOUT = 1
+POSITION_UPDATE_INTERVAL = 1
+PROGRESS_READ_SIZE = 4096
 
 
 @dataclass
@@ -82,9 +91,59 @@ class PlaylistInfo:
     album_art: str | None
 
 
-def to_seconds(value: str) -> int:
-    t = time.fromisoformat(f"{value}0000")
-    return round(delta(hours=t.hour, minutes=t.minute, seconds=t.second, microseconds=t.microsecond).total_seconds())
+# Recently parsed playlists by URL, along with the loop time they were loaded
+PLAYLIST_CACHE: dict[str, tuple[float, PlaylistInfo]] = {}
+
+
+@dataclass
+class CachedMetadata:
+    media_info: MediaInfo | None
+    duration: int | None
+    expires: float | None = None
+
+
+def parse_media_info(metadata: str, uri: str) -> MediaInfo | None:
+    details: dict[str, str] = {}
+    for key, value in METADATA_REGEX.findall(metadata):
+        details.setdefault(key.lower(), value)
+    if details:
+        try:
+            return MediaInfo(**details)
+        except TypeError:
+            pass
+    titles: dict[str, str] = {}
+    for tag, value in TITLE_REGEX.findall(metadata):
+        titles.setdefault(tag, value)
+    for tag in TITLE_TAGS:
+        if tag in titles:
+            return MediaInfo(titles[tag])
+    if uri.startswith("/media/local"):
+        return MediaInfo(unquote(os.path.splitext(os.path.basename(uri))[0]))
+    return None
+
+
+async def read_head(stream: StreamReader, size: int) -> bytes:
+    """Read up to size bytes from the stream, discarding any further output until EOF"""
+    data = bytearray()
+    while chunk := await stream.read(size):
+        data += chunk[: size - len(data)]
+    return bytes(data)
+
+
+def to_seconds(hours: str | bytes, minutes: str | bytes, seconds: str | bytes) -> int:
+    return round(int(hours) * 3600 + int(minutes) * 60 + float(seconds))
+
+
+def resolve_media_url(hass: HomeAssistant, uri: str) -> str:
+    """Resolve a URI to an ffmpeg input, reading media source files from disk rather than over HTTP"""
+    parts = urlparse(uri).path.split("/", 3)
+    if uri.startswith("/media/") and len(parts) == 4:
+        _, _, source_dir_id, path = parts
+        if (media_dir := hass.config.media_dirs.get(source_dir_id)) is not None:
+            file_path = os.path.normpath(os.path.join(media_dir, unquote(path)))
+            if file_path.startswith(os.path.join(media_dir, "")):
+                return file_path
+    return async_process_play_media_url(hass, uri)
 
 
 def setup_platform(
@@ -108,32 +167,66 @@ def setup_platform(
     add_entities([player_entity])
 
 
+def resolve_playlist_uri(dirname: str, uri: str) -> str:
+    if uri.startswith("/") or "://" in uri:
+        return uri
+    return os.path.join(dirname, uri)
+
+
+def read_playlist_file(path: str) -> str:
+    with open(path) as playlist_file:
+        return playlist_file.read(64 * 1024)
+
+
 async def parse_playlist(hass: HomeAssistant, url: str) -> PlaylistInfo:
+    now = hass.loop.time()
+    if (cached := PLAYLIST_CACHE.get(url)) is not None and now - cached[0] < PLAYLIST_CACHE_TTL:
+        return cached[1]
+    playlist = await load_playlist(hass, url)
+    for key in [key for key, (loaded, _) in PLAYLIST_CACHE.items() if now - loaded >= PLAYLIST_CACHE_TTL]:
+        del PLAYLIST_CACHE[key]
+    if len(PLAYLIST_CACHE) >= PLAYLIST_CACHE_SIZE:
+        # Entries are in insertion order, evict the oldest
+        del PLAYLIST_CACHE[next(iter(PLAYLIST_CACHE))]
+    PLAYLIST_CACHE[url] = (now, playlist)
+    return playlist
+
+
+async def load_playlist(hass: HomeAssistant, url: str) -> PlaylistInfo:
     dirname = os.path.dirname(url)
     if url.startswith("/media/local"):
         url = url.replace("/local", "", 1)
-        with open(url) as playlist_file:
-            playlist_data = playlist_file.read(64 * 1024)
+        playlist_data = await hass.async_add_executor_job(read_playlist_file, url)
     else:
+        from homeassistant.helpers import aiohttp_client
+
         session = aiohttp_client.async_get_clientsession(hass, verify_ssl=False)
-        async with session.get(url, timeout=5) as resp:
+        async with session.get(url, timeout=PLAYLIST_TIMEOUT) as resp:
             charset = resp.charset or "utf-8"
             playlist_data = (await resp.content.read(64 * 1024)).decode(charset)
 
+    items = []
     custom_tags = {}
+    is_variant = False
+    for line in playlist_data.lstrip("\ufeff").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#"):
+            if line.startswith(CUSTOM_TAG_PREFIXES):
+                tag, _, value = line[1:].partition(":")
+                custom_tags[tag] = value
+            is_variant = line.startswith("#EXT-X-STREAM-INF:")
+            continue
+        # Variant streams of HLS master playlists aren't playable tracks
+        if not is_variant:
+            items.append(line)
+        is_variant = False
 
-    def tag_handler(line: str, *_) -> bool:
-        for tag in ("EXTIMG", "EXTVLCOPT"):
-            if line.startswith(f"#{tag}:"):
-                custom_tags[tag] = line.split(":")[1]
-                return True
-        return False
-
-    playlist = m3u8.loads(playlist_data, custom_tags_parser=tag_handler)
     album_art = custom_tags.get("EXTIMG")
     return PlaylistInfo(
-        [os.path.join(dirname, item.uri) for item in playlist.segments],
-        os.path.join(dirname, album_art) if album_art is not None else None,
+        [resolve_playlist_uri(dirname, item) for item in items],
+        resolve_playlist_uri(dirname, album_art) if album_art is not None else None,
     )
 
 
@@ -148,11 +241,11 @@ class SnapcastPlayer(MediaPlayerEntity):
         start_delay: str | None,
         hass: HomeAssistant,
     ) -> None:
-        self._host = host
-        self._port = port
         self._attr_state = MediaPlayerState.IDLE
         self._name = name
-        self._start_delay = start_delay
+        delay_args = () if start_delay is None else ("-af", f"adelay={start_delay}:all=true")
+        out_arg = host if host.startswith("/") else f"tcp://{host}:{port}"
+        self._output_args = (*OUTPUT_FORMAT_ARGS, *delay_args, out_arg)
         self._uri: str | None = None
         self._proc: Process | None = None
         self._is_stopped = False
@@ -160,7 +253,12 @@ class SnapcastPlayer(MediaPlayerEntity):
         self._attr_unique_id = name
         self.hass = hass
         self._queue: list[str] = []
+        self._queue_index = 0
         self._seek_position: float | None = None
+        self._metadata_cache: dict[str, CachedMetadata] = {}
+        self._spawn_lock = asyncio.Lock()
+        self._playback_task: asyncio.Task | None = None
+        self._supported_features: MediaPlayerEntityFeature | None = None
 
     async def async_play_media(self, media_type: MediaType | str, media_id: str, **kwargs: Any) -> None:
         # TODO: Support queuing items
@@ -175,33 +273,39 @@ class SnapcastPlayer(MediaPlayerEntity):
             return
 
         self._queue = []
+        self._queue_index = 0
+        self._supported_features = None
         self._attr_media_image_url = None
-        if media_id.endswith(".m3u8") or media_id.endswith(".m3u"):
+        if media_id.endswith(PLAYLIST_EXTENSIONS):
             playlist = await parse_playlist(self.hass, media_id)
             if not playlist.items:
                 return
-            for item in playlist.items:
-                self._queue.append(item)
-            self._uri = self._queue[0]
+            self._queue = list(playlist.items)
+            self._select_track(0)
             if playlist.album_art:
                 self._attr_media_image_url = async_process_play_media_url(self.hass, playlist.album_art)
         else:
             self._uri = media_id
 
         if self._uri:
+            # Only keep metadata for the tracks that can still be played
+            queued = set(self._queue)
+            queued.add(self._uri)
+            self._metadata_cache = {uri: cached for uri, cached in self._metadata_cache.items() if uri in queued}
             self._proc = await self._start_playback(self._uri)
-            self.hass.async_create_task(self._on_process_complete())
+            self._watch_playback()
 
     @property
     def _next_track(self) -> str | None:
-        if self._uri:
-            try:
-                cur_index = self._queue.index(self._uri)
-                return self._queue[cur_index + 1]
-            except (ValueError, IndexError):
-                pass
+        if self._uri and self._queue_index + 1 < len(self._queue):
+            return self._queue[self._queue_index + 1]
         return None
 
+    def _select_track(self, index: int) -> None:
+        self._queue_index = index
+        self._uri = self._queue[index]
+        self._supported_features = None
+
     async def _on_announcement_complete(self, is_live_content: bool):
         if self._proc is not None and self._proc.returncode is None:
             await self._proc.wait()
@@ -210,58 +314,79 @@ class SnapcastPlayer(MediaPlayerEntity):
                 self._uri,
                 position=None if is_live_content else self._attr_media_position,
             )
-            self.hass.async_create_task(self._on_process_complete())
+            self._watch_playback()
+
+    def _watch_playback(self) -> None:
+        # Replace the previous watcher, it would otherwise race with the new one when its process is terminated
+        if self._playback_task is not None:
+            self._playback_task.cancel()
+        self._playback_task = self.hass.async_create_task(self._on_process_complete())
 
     async def _on_process_complete(self):
         while True:
             returncode = await self._proc.wait()
             repeat_modes = [RepeatMode.ONE, RepeatMode.ALL]
             if returncode != 0 or (self._attr_repeat not in repeat_modes and self._next_track is None):
-                self.hass.async_create_task(self.async_update())
+                await self.async_update()
                 return
             if self._next_track:
-                self._uri = self._next_track
+                self._select_track(self._queue_index + 1)
             if self._uri:
                 self._proc = await self._start_playback(self._uri)
 
     @property
     def _previous_track(self) -> str | None:
-        if self._uri:
-            try:
-                cur_index = self._queue.index(self._uri)
-                if cur_index > 0:
-                    return self._queue[cur_index - 1]
-                return self._queue[cur_index]
-            except ValueError:
-                pass
+        if self._uri and self._queue:
+            return self._queue[max(self._queue_index - 1, 0)]
         return None
 
     async def async_media_seek(self, position: float) -> None:
         if self._uri:
             self._proc = await self._start_playback(self._uri, position)
-            self.hass.async_create_task(self._on_process_complete())
+            self._watch_playback()
 
     async def async_media_next_track(self) -> None:
         if self._next_track:
-            self._uri = self._next_track
+            self._select_track(self._queue_index + 1)
         if self._uri:
             self._proc = await self._start_playback(self._uri)
-            self.hass.async_create_task(self._on_process_complete())
+            self._watch_playback()
 
     async def async_media_previous_track(self) -> None:
         if self._previous_track:
-            self._uri = self._previous_track
+            self._select_track(max(self._queue_index - 1, 0))
         if self._uri:
             self._proc = await self._start_playback(self._uri)
-            self.hass.async_create_task(self._on_process_complete())
+            self._watch_playback()
 
     async def _get_metadata(self) -> MediaInfo | None:
-        if self._uri is None:
+        if (uri := self._uri) is None:
             return None
+        now = self.hass.loop.time()
+        cached = self._metadata_cache.get(uri)
+        if cached is None or (cached.expires is not None and now >= cached.expires):
+            cached = await self._probe_metadata(uri)
+            if cached is None:
+                return None
+            # Metadata can change during network streams, local files are only probed once
+            if uri.startswith(("http://", "https://")):
+                cached.expires = now + METADATA_TTL
+            self._metadata_cache[uri] = cached
+        self._attr_media_duration = cached.duration
+        return cached.media_info
+
+    async def _probe_metadata(self, uri: str) -> CachedMetadata | None:
         proc = await asyncio.create_subprocess_exec(
-            "ffmpeg",
+            FFMPEG,
+            "-nostdin",
+            "-hide_banner",
+            "-nostats",
+            "-probesize",
+            "64k",
+            "-analyzeduration",
+            "500000",
             "-i",
-            async_process_play_media_url(self.hass, self._uri),
+            resolve_media_url(self.hass, uri),
             "-f",
             "ffmetadata",
             "-",
@@ -270,87 +395,88 @@ class SnapcastPlayer(MediaPlayerEntity):
             limit=BUF_SIZE,
             close_fds=True,
         )
-        stdout, stderr = await proc.communicate()
+        # Always set, as the process is started with stdout=PIPE and stderr=PIPE
+        assert proc.stdout is not None and proc.stderr is not None
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                asyncio.gather(read_head(proc.stdout, BUF_SIZE), read_head(proc.stderr, BUF_SIZE)),
+                timeout=METADATA_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return None
+        await proc.wait()
         # Parse the ffmpeg output
-        if proc.returncode == 0:
-            stream_info = stderr.decode("utf-8", errors="ignore")
-            duration = None
-            if match := DURATION_REGEX.search(stream_info):
-                duration = to_seconds(match.group(1))
-            self._attr_media_duration = duration
-            metadata = stdout.decode("utf-8", errors="ignore")
-            details = {}
-            for regex in METADATA_REGEXES:
-                if match := regex.search(metadata):
-                    details[match.group(1).lower()] = match.group(2)
-            if details:
-                try:
-                    return MediaInfo(**details)
-                except TypeError:
-                    pass
-            for title_regex in TITLE_REGEXES:
-                if match := title_regex.search(metadata):
-                    return MediaInfo(match.group(1))
-            if self._uri.startswith("/media/local"):
-                return MediaInfo(unquote(os.path.splitext(os.path.basename(self._uri))[0]))
-        return None
-
-    async def _read_ffmpeg_progress(self):
-        while True:
-            if self._proc and self._proc.returncode is None and not self._proc.stderr.at_eof():
-                try:
-                    data = await self._proc.stderr.readuntil(b"\r")
-                except IncompleteReadError:
-                    return
-                if match := PROGRESS_REGEX.search(data.decode("utf-8", errors="ignore")):
-                    position = to_seconds(match.group(1))
-                    if self._seek_position:
-                        position += round(self._seek_position)
-                    self._attr_media_position = position
-                    self._attr_media_position_updated_at = utcnow()
-            else:
-                self._attr_media_position = None
-                return
+        if proc.returncode != 0:
+            return None
+        stream_info = stderr.decode("utf-8", errors="ignore")
+        duration = None
+        if match := DURATION_REGEX.search(stream_info):
+            duration = to_seconds(*match.groups())
+        metadata = stdout.decode("utf-8", errors="ignore")
+        return CachedMetadata(parse_media_info(metadata, uri), duration)
+
+    async def _read_ffmpeg_progress(self, proc: Process):
+        loop = asyncio.get_running_loop()
+        last_update = loop.time()
+        tail = b""
+        # Always set, as the process is started with stderr=PIPE
+        assert proc.stderr is not None
+        stderr = proc.stderr
+        while chunk := await stderr.read(PROGRESS_READ_SIZE):
+            data = tail + chunk
+            # Keep the incomplete status line for the next read
+            end = data.rfind(b"\r")
+            if end == -1:
+                tail = data[-PROGRESS_READ_SIZE:]
+                continue
+            tail = data[end + 1 :]
+            # ffmpeg reports progress several times a second, the position only has a resolution of 1s
+            now = loop.time()
+            if now - last_update < POSITION_UPDATE_INTERVAL:
+                continue
+            # Only the most recent progress line is needed
+            start = data.rfind(b"time=", 0, end)
+            if start != -1 and (match := PROGRESS_REGEX.match(data, start, end)):
+                last_update = now
+                position = to_seconds(*match.groups())
+                if self._seek_position:
+                    position += round(self._seek_position)
+                self._attr_media_position = position
+                self._attr_media_position_updated_at = utcnow()
 
     async def _start_playback(self, uri: str, position: float | None = None, announcement: bool = False) -> Process:
-        if self._proc and self._proc.returncode is None:
-            self._proc.terminate()
-            self._is_stopped = False
-
-        format_args = [
-            "-f",
-            "u16le",
-            "-acodec",
-            "pcm_s16le",
-            "-ac",
-            "2",
-            "-ar",
-            "48000",
-        ]
-        delay_args = [] if self._start_delay is None else ["-af", f"adelay={self._start_delay}:all=true"]
-        if self._host.startswith("/"):
-            out_arg = self._host
-        else:
-            out_arg = f"tcp://{self._host}:{self._port}"
-        seek_args = ["-ss", str(timedelta(seconds=round(position)))] if position else []
-        self._seek_position = position
-        process_args = [
-            "ffmpeg",
-            "-y",
-            *seek_args,
-            "-i",
-            async_process_play_media_url(self.hass, uri),
-            *format_args,
-            *delay_args,
-            out_arg,
-        ]
-        proc = await asyncio.create_subprocess_exec(*process_args, stderr=PIPE, limit=BUF_SIZE, close_fds=True)
-        self._attr_state = MediaPlayerState.PLAYING
-        if not announcement:
-            self._attr_media_position = round(self._seek_position) if self._seek_position else 0
-            self._attr_media_position_updated_at = utcnow()
-            self.hass.async_create_task(self._read_ffmpeg_progress())
-        return proc
+        # Wait for the previous process to exit so only one ffmpeg process runs at a time
+        async with self._spawn_lock:
+            if self._proc and self._proc.returncode is None:
+                self._proc.terminate()
+                if self._is_stopped:
+                    self._proc.send_signal(signal.SIGCONT)
+                try:
+                    await asyncio.wait_for(self._proc.wait(), timeout=PROCESS_STOP_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self._proc.kill()
+                self._is_stopped = False
+
+            seek_args = ("-ss", str(timedelta(seconds=round(position)))) if position else ()
+            self._seek_position = position
+            process_args = (
+                FFMPEG,
+                "-y",
+                *seek_args,
+                "-i",
+                resolve_media_url(self.hass, uri),
+                *self._output_args,
+            )
+            proc = await asyncio.create_subprocess_exec(*process_args, stderr=PIPE, limit=BUF_SIZE, close_fds=True)
+            self._attr_state = MediaPlayerState.PLAYING
+            if not announcement:
+                self._attr_media_position = round(self._seek_position) if self._seek_position else 0
+                self._attr_media_position_updated_at = utcnow()
+                self.hass.async_create_task(self._read_ffmpeg_progress(proc))
+            self._supported_features = None
+            return proc
 
     @property
     def media_artist(self) -> str | None:
@@ -364,6 +490,9 @@ class SnapcastPlayer(MediaPlayerEntity):
         self._attr_repeat = repeat
 
     async def async_update(self):
+        if self._spawn_lock.locked():
+            # Playback is being restarted, the current process is about to be replaced
+            return
         if self._proc is not None and self._proc.returncode is None:
             self._attr_state = MediaPlayerState.PAUSED if self._is_stopped else MediaPlayerState.PLAYING
             self._media_info = await self._get_metadata()
@@ -375,6 +504,8 @@ class SnapcastPlayer(MediaPlayerEntity):
             self._attr_repeat = RepeatMode.OFF
             self._attr_state = MediaPlayerState.IDLE
             self._attr_media_image_url = None
+        # The process or duration may have changed
+        self._supported_features = None
 
     @property
     def media_content_id(self) -> str | None:
@@ -391,6 +522,8 @@ class SnapcastPlayer(MediaPlayerEntity):
     def media_stop(self) -> None:
         if self._proc is not None:
             self._queue = []
+            self._queue_index = 0
+            self._supported_features = None
             self._proc.terminate()
             self.hass.create_task(self.async_update())
 
@@ -408,6 +541,9 @@ class SnapcastPlayer(MediaPlayerEntity):
 
     @property
     def supported_features(self) -> MediaPlayerEntityFeature:
+        # Only changes when the track or process changes, or after an update
+        if self._supported_features is not None:
+            return self._supported_features
         features = (
             MediaPlayerEntityFeature.PLAY_MEDIA
             | MediaPlayerEntityFeature.BROWSE_MEDIA
@@ -422,6 +558,7 @@ class SnapcastPlayer(MediaPlayerEntity):
             features |= MediaPlayerEntityFeature.NEXT_TRACK
         if self._previous_track:
             features |= MediaPlayerEntityFeature.PREVIOUS_TRACK
+        self._supported_features = features
         return features
 
     async def async_browse_media(self, media_content_type: str | None = None, media_content_id: str | None = None):